@@ -3,7 +3,7 @@ python_blackbox.py
 
 Block common network access at the Python level to reduce risk of data exfiltration
 when running scripts. This module monkey-patches common networking primitives
-(socket, urllib, http.client, requests, SSLContext.wrap_socket) so that attempts
+(socket, urllib, http.client, requests) so that attempts
 to open outbound network connections raise a `NetworkBlockedError`.
 
 Usage:
@@ -26,12 +26,15 @@ Limitations:
       the script in a container without network access.
 """
 
-from contextlib import contextmanager
+import functools
 import os
 import socket
-import ssl
+import sys
+import threading
 import urllib.request
+from urllib.parse import urlparse
 import http.client
+import ipaddress
 
 # Optional: detect requests and patch if available
 try:
@@ -39,144 +42,321 @@ try:
 except Exception:
     requests = None
 
-# Saved originals
-_ORIG = {}
+# Saved originals (None while not blocked)
+_orig_socket_socket = None
+_orig_create_connection = None
+_orig_urlopen = None
+_orig_http_connect = None
+_orig_requests_request = None
 _BLOCKED = False
+# Serializes patching/unpatching across threads
+_PATCH_LOCK = threading.Lock()
+# Open allow_temporary() blocks, and whether the last one out must re-block
+_NEST_DEPTH = 0
+_REBLOCK_ON_EXIT = False
+# Normalized (stripped, lowercased, interned) entries; also the exact-host index
 _WHITELIST = set()
-_DEBUG = os.environ.get("PYTHON_BLACKBOX_DEBUG", "") in ("1", "true", "True")
+# The same entries as ".domain" suffixes, for subdomain matches
+_WHITELIST_SUFFIX = set()
+# (generation, _WHITELIST_SUFFIX as a tuple) for str.endswith; rebuilt lazily
+# on lookup, and only while the whitelist is small enough to use it
+_WHITELIST_DOT_TUPLE = (-1, ())
+# Bumped after every whitelist change; part of every cached decision's key
+_WHITELIST_GEN = 0
+# Up to this many entries one C-level str.endswith beats walking the labels
+_SUFFIX_TUPLE_MAX = 64
+_TRUTHY = frozenset(("1", "true", "yes", "on"))
+
+def _env_truthy(name):
+    """Return True if environment variable `name` is set to 1/true/yes/on (any case)."""
+    value = os.environ.get(name)
+    return value is not None and value.strip().lower() in _TRUTHY
+
+_DEBUG = _env_truthy("PYTHON_BLACKBOX_DEBUG")
+
+def _log_print(msg: str):
+    print(f"[python_blackbox DEBUG] {msg}")
+
+def _log_noop(msg: str):
+    pass
+
+# Rebound by set_debug() so disabled logging costs a bare call
+_log = _log_print if _DEBUG else _log_noop
 
 def set_debug(enabled: bool):
     """Enable or disable debug logging for python_blackbox."""
-    global _DEBUG
+    global _DEBUG, _log
     _DEBUG = bool(enabled)
+    _log = _log_print if _DEBUG else _log_noop
+    _host_allowed_cached.cache_clear()
 
-def _log(msg: str):
-    if _DEBUG:
-        print(f"[python_blackbox DEBUG] {msg}")
+_LOOPBACK = frozenset(("localhost", "127.0.0.1", "::1"))
 
 # Helper: check if a host is allowed (simple domain/IP match)
 def _host_allowed(host):
     if not host:
         return False
-    # remove port if present
-    if ":" in host:
-        host = host.split(":", 1)[0]
+    # remove port if present; bare IPv6 literals ("::1") have several colons
+    if host.startswith("["):
+        end = host.find("]")
+        host = host[1:end] if end > 0 else host
+    elif host.count(":") == 1:
+        host = host[:host.index(":")]
+    if host in _LOOPBACK:
+        if _DEBUG:
+            _log(f"Allowing access to localhost {host}")
+        return True
+    if _DEBUG:
+        # bypass the cache so every decision is logged
+        return _host_allowed_cached.__wrapped__(host, _WHITELIST_GEN)
+    return _host_allowed_cached(host, _WHITELIST_GEN)
+
+
+# Whitelist decision per (host, whitelist generation). Keying on the generation
+# keeps a lookup that raced with a whitelist change from being reused after it.
+@functools.lru_cache(maxsize=1024)
+def _host_allowed_cached(host, gen):
+    global _WHITELIST_DOT_TUPLE
     host = host.lower()  # <-- Ajouté
-    for w in _WHITELIST:
-        if host == w or host.endswith("." + w):
-            _log(f"Allowing access to whitelisted host {host}")
-            return True
     # always allow localhost/loopback
-    if host in ("localhost", "127.0.0.1", "::1"):
-        _log(f"Allowing access to localhost {host}")
+    if host in _LOOPBACK:
+        if _DEBUG:
+            _log(f"Allowing access to localhost {host}")
+        return True
+    if host in _WHITELIST:
+        if _DEBUG:
+            _log(f"Allowing access to whitelisted host {host}")
         return True
-    _log(f"Blocking host {host}")  
+    if len(_WHITELIST_SUFFIX) <= _SUFFIX_TUPLE_MAX:
+        tuple_gen, suffixes = _WHITELIST_DOT_TUPLE
+        if tuple_gen != _WHITELIST_GEN:
+            # read the generation first: a change during the rebuild leaves a
+            # stale tag, so the next lookup rebuilds again
+            tuple_gen = _WHITELIST_GEN
+            suffixes = tuple(_WHITELIST_SUFFIX)
+            _WHITELIST_DOT_TUPLE = (tuple_gen, suffixes)
+        if host.endswith(suffixes):
+            if _DEBUG:
+                _log(f"Allowing access to whitelisted host {host}")
+            return True
+    else:
+        # walk parent domains: a.b.example.com -> .b.example.com -> .example.com -> .com
+        dot = host.find(".")
+        while dot >= 0:
+            if host[dot:] in _WHITELIST_SUFFIX:
+                if _DEBUG:
+                    _log(f"Allowing access to whitelisted host {host}")
+                return True
+            dot = host.find(".", dot + 1)
+    if _DEBUG:
+        _log(f"Blocking host {host}")
     return False
 
 
+def _slow_hostname(url):
+    try:
+        parts = urlparse(url)
+        host = parts.hostname
+    except ValueError:
+        # malformed netloc (e.g. bad IPv6 brackets): no host to allow
+        return None
+    if host is not None and "[" in parts.netloc:
+        # urlparse only validates bracketed hosts from Python 3.11.4 on; accept
+        # nothing but an IPv6 literal (optionally with a zone ID) everywhere
+        try:
+            ipaddress.IPv6Address(host.partition("%")[0])
+        except ValueError:
+            return None
+    return host
+
+
+# Helper: hostname of a URL, like urlparse(url).hostname but without building a
+# ParseResult for the usual "scheme://[user@]host[:port]/..." form. Anything
+# urlparse might treat differently (non-ASCII, control characters, leading
+# whitespace, odd schemes, IPv6 brackets, "%") goes through _slow_hostname.
+def _fast_hostname(url):
+    i = url.find("://")
+    if (i <= 0 or not url.isascii() or not url.isprintable()
+            or not url[:i].isalpha()):
+        return _slow_hostname(url)
+    start = i + 3
+    end = len(url)
+    for delim in "/?#":
+        j = url.find(delim, start, end)
+        if j >= 0:
+            end = j
+    netloc = url[start:end]
+    # brackets need validating; urlparse keeps the case of text after "%"
+    if "[" in netloc or "]" in netloc or "%" in netloc:
+        return _slow_hostname(url)
+    host = netloc[netloc.rfind("@") + 1:].partition(":")[0]
+    return host.lower() or None
+
+
 class NetworkBlockedError(RuntimeError):
-    """Raised when code attempts network access while blocked."""
-    pass
+    """Raised when code attempts network access while blocked.
+
+    `kind` names the blocked primitive ('connect', 'http', 'urlopen',
+    'requests' or 'socket'); `host` and `port` are the target when known.
+    The message is only formatted when the exception is converted to str.
+    `args` holds (kind, host, port) rather than the message; without a kind
+    the generic 'socket' message is used, and any other unknown kind is
+    shown as-is.
+    """
+    __slots__ = ('kind', 'host', 'port')
+
+    def __init__(self, kind=None, host=None, port=None):
+        super().__init__(kind, host, port)
+        self.kind = kind
+        self.host = host
+        self.port = port
+
+    def __str__(self):
+        if self.kind is None:
+            return _BLOCKED_MESSAGES['socket']
+        template = _BLOCKED_MESSAGES.get(self.kind)
+        if template is None:
+            return str(self.kind)
+        return template.format(host=self.host, port=self.port)
+
+
+_BLOCKED_MESSAGES = {
+    'connect': "Attempt to connect to {host}:{port} blocked by python_blackbox",
+    'http': "HTTP connect to {host} blocked by python_blackbox",
+    'urlopen': "urlopen to {host} blocked by python_blackbox",
+    'requests': "requests to {host} blocked by python_blackbox",
+    'socket': "Network access blocked by python_blackbox",
+}
 
 
 # A socket constructor that always raises to block socket creation
 class _BlockedSocket:
-    def __init__(self, *args, **kwargs):
-        raise NetworkBlockedError("Network access blocked by python_blackbox")
-
+    __slots__ = ()
 
-# Replacement for socket.create_connection with whitelist support
-def _blocked_create_connection(address, timeout=None, source_address=None):
-    host, port = address
-    if _host_allowed(host):
-        return _ORIG['socket.create_connection'](address, timeout, source_address)
-    raise NetworkBlockedError(f"Attempt to connect to {host}:{port} blocked by python_blackbox")
-
-
-# Replacement for http.client.HTTPConnection.connect
-def _blocked_http_connect(self):
-    host = getattr(self, 'host', None)
-    if _host_allowed(host):
-        return _ORIG['http.client.HTTPConnection.connect'](self)
-    raise NetworkBlockedError(f"HTTP connect to {host} blocked by python_blackbox")
+    def __init__(self, *args, **kwargs):
+        raise NetworkBlockedError('socket')
+
+
+# Build the replacement functions around the saved originals. Everything the
+# wrappers touch is bound here, so calls resolve closure cells rather than
+# module globals.
+def _build_wrappers(orig_create_connection, orig_http_connect, orig_urlopen,
+                    orig_requests_request, host_allowed=_host_allowed,
+                    fast_hostname=_fast_hostname, BlockedError=NetworkBlockedError):
+
+    # Replacement for socket.create_connection with whitelist support
+    def _blocked_create_connection(address, timeout=None, source_address=None):
+        host, port = address
+        if host_allowed(host):
+            return orig_create_connection(address, timeout, source_address)
+        raise BlockedError('connect', host, port)
+
+    # Replacement for http.client.HTTPConnection.connect. The decision is kept
+    # on the connection so reconnects (after close()) skip the whitelist check.
+    def _blocked_http_connect(self):
+        host = getattr(self, 'host', None)
+        # read the generation before checking, so a decision that raced with
+        # a whitelist change is stored under the older generation
+        gen = _WHITELIST_GEN
+        cached = getattr(self, '_blackbox_allowed', None)
+        if (cached is not None and cached[0] == gen
+                and cached[1] == host and not _DEBUG):
+            allowed = cached[2]
+        else:
+            allowed = host_allowed(host)
+            try:
+                self._blackbox_allowed = (gen, host, allowed)
+            except AttributeError:
+                pass
+        if allowed:
+            return orig_http_connect(self)
+        raise BlockedError('http', host)
+
+    # Replacement for urllib.request.urlopen
+    def _blocked_urlopen(*args, **kwargs):
+        url = args[0] if args else kwargs.get('url')
+        host = fast_hostname(url) if isinstance(url, str) else None
+        if host_allowed(host):
+            return orig_urlopen(*args, **kwargs)
+        raise BlockedError('urlopen', host)
+
+    # Replacement for requests.Session.request (if requests is installed)
+    def _blocked_requests_request(self, method, url, *args, **kwargs):
+        host = fast_hostname(url) if isinstance(url, str) else None
+        if host_allowed(host):
+            return orig_requests_request(self, method, url, *args, **kwargs)
+        raise BlockedError('requests', host)
+
+    return (_blocked_create_connection, _blocked_http_connect,
+            _blocked_urlopen, _blocked_requests_request)
 
 
-# Replacement for urllib.request.urlopen
-def _blocked_urlopen(*args, **kwargs):
-    url = args[0] if args else kwargs.get('url')
-    host = None
-    if isinstance(url, str):
-        try:
-            import urllib.parse as _up
-            host = _up.urlparse(url).hostname
-        except Exception:
-            host = None
-    if _host_allowed(host):
-        return _ORIG['urllib.request.urlopen'](*args, **kwargs)
-    raise NetworkBlockedError(f"urlopen to {host} blocked by python_blackbox")
+def block_network():
+    """Apply Python-level network blocking. Idempotent."""
+    with _PATCH_LOCK:
+        _patch()
 
 
-# Replacement for requests.Session.request (if requests is installed)
-def _blocked_requests_request(self, method, url, *args, **kwargs):
-    try:
-        import urllib.parse as _up
-        host = _up.urlparse(url).hostname
-    except Exception:
-        host = None
-    if _host_allowed(host):
-        return _ORIG['requests.Session.request'](self, method, url, *args, **kwargs)
-    raise NetworkBlockedError(f"requests to {host} blocked by python_blackbox")
+def allow_network():
+    """Restore original networking functions."""
+    with _PATCH_LOCK:
+        _unpatch()
 
 
-def block_network():
-    """Apply Python-level network blocking. Idempotent."""
-    global _BLOCKED
+# Install the wrappers; caller holds _PATCH_LOCK
+def _patch():
+    global _BLOCKED, _orig_socket_socket, _orig_create_connection
+    global _orig_urlopen, _orig_http_connect, _orig_requests_request
     if _BLOCKED:
         return
     # Save originals
-    _ORIG['socket.socket'] = socket.socket
-    _ORIG['socket.create_connection'] = socket.create_connection
-    _ORIG['urllib.request.urlopen'] = urllib.request.urlopen
-    _ORIG['http.client.HTTPConnection.connect'] = http.client.HTTPConnection.connect
+    _orig_socket_socket = socket.socket
+    _orig_create_connection = socket.create_connection
+    _orig_urlopen = urllib.request.urlopen
+    _orig_http_connect = http.client.HTTPConnection.connect
+    if requests is not None:
+        _orig_requests_request = requests.Session.request
+
+    (blocked_create_connection, blocked_http_connect,
+     blocked_urlopen, blocked_requests_request) = _build_wrappers(
+        _orig_create_connection, _orig_http_connect,
+        _orig_urlopen, _orig_requests_request)
 
     # Patch create_connection to check whitelist
-    socket.create_connection = _blocked_create_connection
+    socket.create_connection = blocked_create_connection
 
     # Patch urllib / http.client
-    urllib.request.urlopen = _blocked_urlopen
-    http.client.HTTPConnection.connect = _blocked_http_connect
+    urllib.request.urlopen = blocked_urlopen
+    http.client.HTTPConnection.connect = blocked_http_connect
 
     # Patch requests if present
     if requests is not None:
-        _ORIG['requests.Session.request'] = requests.Session.request
-        requests.Session.request = _blocked_requests_request
+        requests.Session.request = blocked_requests_request
 
     _BLOCKED = True
 
     _log("Network access blocked.")
 
 
-def allow_network():
-    """Restore original networking functions."""
-    global _BLOCKED
+# Restore the saved originals; caller holds _PATCH_LOCK
+def _unpatch():
+    global _BLOCKED, _orig_socket_socket, _orig_create_connection
+    global _orig_urlopen, _orig_http_connect, _orig_requests_request
     if not _BLOCKED:
         return
     # restore saved originals
-    for k, v in list(_ORIG.items()):
-        if k == 'socket.socket':
-            socket.socket = v
-        elif k == 'socket.create_connection':
-            socket.create_connection = v
-        elif k == 'urllib.request.urlopen':
-            urllib.request.urlopen = v
-        elif k == 'http.client.HTTPConnection.connect':
-            http.client.HTTPConnection.connect = v
-        elif k == 'ssl.SSLContext.wrap_socket' and hasattr(ssl, 'SSLContext'):
-            ssl.SSLContext.wrap_socket = v
-        elif k == 'requests.Session.request' and requests is not None:
-            requests.Session.request = v
-
-    _ORIG.clear()
+    socket.socket = _orig_socket_socket
+    socket.create_connection = _orig_create_connection
+    urllib.request.urlopen = _orig_urlopen
+    http.client.HTTPConnection.connect = _orig_http_connect
+    if _orig_requests_request is not None:
+        requests.Session.request = _orig_requests_request
+
+    _orig_socket_socket = None
+    _orig_create_connection = None
+    _orig_urlopen = None
+    _orig_http_connect = None
+    _orig_requests_request = None
     _BLOCKED = False
 
     _log("Network access allowed.")
@@ -186,33 +366,68 @@ def is_blocked():
     return _BLOCKED
 
 
-@contextmanager
-def allow_temporary():
-    """Context manager that temporarily allows network access inside the with-block."""
-    _log("Entering allow_temporary context")
-    was_blocked = is_blocked()
-    if was_blocked:
-        allow_network()
-    try:
-        yield
-    finally:
-        if was_blocked:
-            block_network()
+class allow_temporary:
+    """Context manager that temporarily allows network access inside the with-block.
+
+    Nested or concurrent blocks share the outermost unpatch: that blocking is
+    restored when the last open block exits. A block entered after an explicit
+    block_network() inside another block re-blocks on its own exit.
+    """
+    __slots__ = ('_reblock',)
+
+    def __enter__(self):
+        global _NEST_DEPTH, _REBLOCK_ON_EXIT
+        _log("Entering allow_temporary context")
+        with _PATCH_LOCK:
+            self._reblock = False
+            if _BLOCKED:
+                _unpatch()
+                if _NEST_DEPTH == 0:
+                    _REBLOCK_ON_EXIT = True
+                else:
+                    self._reblock = True
+            _NEST_DEPTH += 1
+        return self
+
+    def __exit__(self, *exc):
+        global _NEST_DEPTH, _REBLOCK_ON_EXIT
+        with _PATCH_LOCK:
+            _NEST_DEPTH -= 1
+            if self._reblock:
+                _patch()
+            if _NEST_DEPTH == 0 and _REBLOCK_ON_EXIT:
+                _REBLOCK_ON_EXIT = False
+                _patch()
 
 
 def add_whitelist(host_or_domain):
     """Add a host or domain to the whitelist (e.g. 'example.com' or 'api.example.com')."""
-    _WHITELIST.add(host_or_domain)
-    _log("Host/domain added to whitelist: " + host_or_domain)
+    global _WHITELIST_GEN
+    entry = host_or_domain.strip().lower()
+    if not entry:
+        raise ValueError("whitelist entry must be a non-empty host or domain")
+    entry = sys.intern(entry)
+    _WHITELIST.add(entry)
+    _WHITELIST_SUFFIX.add("." + entry)
+    _WHITELIST_GEN += 1
+    _host_allowed_cached.cache_clear()
+    if _DEBUG:
+        _log("Host/domain added to whitelist: " + host_or_domain)
 
 
 def remove_whitelist(host_or_domain):
-    _WHITELIST.discard(host_or_domain)
-    _log("Host/domain removed from whitelist: " + host_or_domain)
+    global _WHITELIST_GEN
+    entry = host_or_domain.strip().lower()
+    _WHITELIST.discard(entry)
+    _WHITELIST_SUFFIX.discard("." + entry)
+    _WHITELIST_GEN += 1
+    _host_allowed_cached.cache_clear()
+    if _DEBUG:
+        _log("Host/domain removed from whitelist: " + host_or_domain)
 
 
 # Auto-block on import unless disabled via environment variable
-if os.environ.get("PYTHON_BLACKBOX_NOAUTO", "") in ("1", "true", "True"):
+if _env_truthy("PYTHON_BLACKBOX_NOAUTO"):
     # do not auto-block
     pass
 else:
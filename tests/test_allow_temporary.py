@@ -0,0 +1,92 @@
+import os
+import socket
+import threading
+
+os.environ.setdefault("PYTHON_BLACKBOX_NOAUTO", "1")
+
+import python_blackbox  # noqa: E402
+
+
+def _reset():
+    python_blackbox.allow_network()
+    assert python_blackbox._NEST_DEPTH == 0
+
+
+def test_restores_blocking_on_exit():
+    original = socket.create_connection
+    python_blackbox.block_network()
+    try:
+        with python_blackbox.allow_temporary():
+            assert not python_blackbox.is_blocked()
+            assert socket.create_connection is original
+        assert python_blackbox.is_blocked()
+    finally:
+        _reset()
+
+
+def test_leaves_unblocked_network_unblocked():
+    with python_blackbox.allow_temporary():
+        assert not python_blackbox.is_blocked()
+    assert not python_blackbox.is_blocked()
+
+
+def test_nested_blocks_reblock_only_at_outermost_exit():
+    python_blackbox.block_network()
+    try:
+        with python_blackbox.allow_temporary():
+            with python_blackbox.allow_temporary():
+                assert not python_blackbox.is_blocked()
+            assert not python_blackbox.is_blocked()
+        assert python_blackbox.is_blocked()
+    finally:
+        _reset()
+
+
+def test_explicit_block_inside_block_is_restored_by_inner_exit():
+    python_blackbox.block_network()
+    try:
+        with python_blackbox.allow_temporary():
+            python_blackbox.block_network()
+            with python_blackbox.allow_temporary():
+                assert not python_blackbox.is_blocked()
+            assert python_blackbox.is_blocked()
+        assert python_blackbox.is_blocked()
+    finally:
+        _reset()
+
+
+def test_explicit_block_inside_unblocked_block_is_restored():
+    with python_blackbox.allow_temporary():
+        python_blackbox.block_network()
+        with python_blackbox.allow_temporary():
+            assert not python_blackbox.is_blocked()
+        assert python_blackbox.is_blocked()
+    assert python_blackbox.is_blocked()
+    _reset()
+
+
+def test_overlapping_blocks_across_threads():
+    python_blackbox.block_network()
+    inner_entered = threading.Event()
+    outer_exited = threading.Event()
+    seen = []
+
+    def worker():
+        with python_blackbox.allow_temporary():
+            inner_entered.set()
+            outer_exited.wait(5)
+            seen.append(python_blackbox.is_blocked())
+
+    try:
+        outer = python_blackbox.allow_temporary()
+        outer.__enter__()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert inner_entered.wait(5)
+        outer.__exit__(None, None, None)
+        outer_exited.set()
+        thread.join(5)
+        assert seen == [False]
+        assert python_blackbox.is_blocked()
+    finally:
+        _reset()
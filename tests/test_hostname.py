@@ -0,0 +1,71 @@
+import os
+
+os.environ.setdefault("PYTHON_BLACKBOX_NOAUTO", "1")
+
+import python_blackbox  # noqa: E402
+
+# _fast_hostname gates the whitelist, so it must never disagree with the
+# urlparse-based _slow_hostname
+URLS = [
+    "https://httpbin.org/get",
+    "http://httpbin.org",
+    "HTTP://Example.COM:8080/path?q=1#frag",
+    "http://user:pw@example.com:80/x",
+    "http://a@b@example.com/",
+    "http://evil.com#@allowed.com/",
+    "http://evil.com?a=@allowed.com",
+    "http://evil.com/@allowed.com",
+    "http://[::1]:443/",
+    "http://[::1]/",
+    "http://[::1/",
+    "http://::1]/",
+    "http://[allowed.com]/",
+    "http://[fe80::1%25eth0]:8/",
+    "http://[FE80::1%25ETH0]/",
+    "http://%HT",
+    "http://Host%2Ecom/",
+    "http://user%40x@Example.com/",
+    "http://[v1.allowed.com]/",
+    "http://[::1]@allowed.com/",
+    "http://evil.com[x]@allowed.com/",
+    "http://evil.com＠x.allowed.com/",
+    "http://exämple.com/",
+    "http://a.b\n@c.d",
+    "http://a.b\t.allowed.com/",
+    "  http://a.b ",
+    "\x00http://a.b/",
+    "http://",
+    "http://:80/",
+    "http://@/",
+    "file:///etc/passwd",
+    "foo?x=http://allowed.com",
+    "git+ssh://host/x",
+    "1http://host/",
+    "://host/",
+    "",
+]
+
+
+def test_fast_hostname_matches_urlparse():
+    for url in URLS:
+        assert python_blackbox._fast_hostname(url) == python_blackbox._slow_hostname(url), url
+
+
+def test_bracketed_and_non_ascii_hosts_do_not_match_whitelist():
+    python_blackbox.add_whitelist("allowed.com")
+    try:
+        for url in ("http://[allowed.com]/", "http://evil.com＠x.allowed.com/"):
+            assert not python_blackbox._host_allowed(python_blackbox._fast_hostname(url)), url
+    finally:
+        python_blackbox.remove_whitelist("allowed.com")
+
+
+def test_blank_whitelist_entry_is_rejected():
+    for entry in ("", "   "):
+        try:
+            python_blackbox.add_whitelist(entry)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"{entry!r} was accepted")
+    assert not python_blackbox._host_allowed("evil.com.")